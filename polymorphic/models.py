@@ -1,6 +1,41 @@
+import operator
+from itertools import chain
+
 from django.db import models
 from django.db import connection
+from django.db import transaction
 from django.db.models.expressions import Col
+from django.db.models.sql import Query
+from django.utils.functional import cached_property
+
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+_col_name = operator.attrgetter('target.column')
+
+_TRIGGER_FUNCTION_TEMPLATE = (
+    'CREATE OR REPLACE FUNCTION {trigger_func_name} RETURNS trigger as '
+        '$$ '
+            'BEGIN '
+                'BEGIN '
+                    'INSERT INTO {reference_model_table_name}'
+                        '({insert_cols}) '
+                        'VALUES ({insert_values})'
+                    '; '
+                'EXCEPTION WHEN unique_violation THEN '
+                    'UPDATE {reference_model_table_name}'
+                        ' SET ({proxy_cols}) = ({foreign_values})'
+                        ' WHERE {column} = NEW.{fk_col_name}'
+                    '; '
+                'END; '
+            'RETURN NEW; '
+            'END '
+        '$$ LANGUAGE plpgsql'
+    ';'
+)  # nopep8
 
 
 class ReferenceSource(models.OneToOneField):
@@ -14,27 +49,31 @@ class ReferenceSource(models.OneToOneField):
         default_kwargs.update(kwargs)
         super(ReferenceSource, self).__init__(*args, **default_kwargs)
 
-    @property
+    # The names below only depend on the two models' metadata. They are
+    # cached lazily because related_model is not available until the app
+    # registry is ready, which rules out computing them in
+    # contribute_to_class.
+    @cached_property
     def source_table_name(self):
         return self.related_model._meta.db_table
 
-    @property
+    @cached_property
     def reference_model_table_name(self):
         return self.model._meta.db_table
 
-    @property
+    @cached_property
     def trigger_name(self):
         return 'update_{}_{}_trigger'.format(
             self.source_table_name, self.reference_model_table_name
         )
 
-    @property
+    @cached_property
     def index_name(self):
         return 'unique_{}_{}_ix'.format(
             self.source_table_name, self.reference_model_table_name
         )
 
-    @property
+    @cached_property
     def trigger_function_name(self):
         return 'update_{}_{}_()'.format(
             self.source_table_name, self.reference_model_table_name
@@ -43,7 +82,7 @@ class ReferenceSource(models.OneToOneField):
     @classmethod
     def _find_cols(cls, parent):
         from django.db.models.lookups import Lookup
-        if isinstance(parent, basestring):
+        if isinstance(parent, string_types):
             return
         elif isinstance(parent, Col):
             yield parent
@@ -64,16 +103,38 @@ class ReferenceSource(models.OneToOneField):
                             yield inner_expr
 
     def get_proxy_and_foreign_cols(self):
+        # Compiling the proxy expressions is expensive and the result only
+        # depends on model metadata, so it is shared by every statement.
+        try:
+            return self._proxy_and_foreign_cols
+        except AttributeError:
+            self._proxy_and_foreign_cols = cols = \
+                self._build_proxy_and_foreign_cols()
+            return cols
+
+    def _build_proxy_and_foreign_cols(self):
         proxies = self.model.get_field_proxies()
-        overrides = {
-            proxy.reference_field: value
-            for proxy in [p for p in proxies if p.foreign_fields]
-                for field, value in proxy.foreign_fields.iteritems()
-                    if field == self.name
-        }  # nopep8
+        # foreign_fields is keyed on the ReferenceSource object declared in
+        # the model body; its name is accepted too.
+        overrides = {}
+        for proxy in proxies:
+            foreign_fields = proxy.foreign_fields
+            if not foreign_fields:
+                continue
+            for field, value in foreign_fields.items():
+                if field is self or field == self.name:
+                    overrides[proxy.reference_field] = value
         proxy_field_cols = []
         foreign_cols = []
 
+        # Every expression is resolved against one bare query of the source
+        # model; only their SQL is needed, not a full QuerySet. Sharing the
+        # query also shares its compiler (and its quoting cache). Joins
+        # trimmed while resolving fk columns pile up in its alias_map, so
+        # the single-table check below looks at each expression instead.
+        query = Query(self.related_model)
+        compiler = query.get_compiler(using='default')
+
         for proxy in proxies:
             proxy_field_col = proxy.foreign_column
             foreign_col = overrides.get(proxy.reference_field, proxy_field_col)
@@ -83,16 +144,16 @@ class ReferenceSource(models.OneToOneField):
                 else:
                     foreign_expression = foreign_col
 
-                # Generate a qs, and grab the annotation from it.
-                qs = self.related_model.objects.annotate(
-                    ann_forex=foreign_expression
-                )
-                ann = qs.query.annotations['ann_forex']
+                ann = foreign_expression.resolve_expression(query)
 
+                # Only look at the columns the expression reads. Resolving
+                # a source fk (e.g. F('owner_id')) sets up and then trims a
+                # join, so the query's alias_map isn't a reliable signal.
+                # Joined references like F('owner__name') read a column of
+                # the joined table's alias and are rejected here.
                 extra_tables = {
                     exp.alias for exp in self._find_cols(ann)
-                    if isinstance(exp, Col)
-                    and exp.alias != self.source_table_name
+                    if exp.alias != self.source_table_name
                 }
 
                 if extra_tables:
@@ -103,7 +164,6 @@ class ReferenceSource(models.OneToOneField):
 
                 # The rendered SQL refers to the tablename when we want
                 # it to refer to NEW
-                compiler = qs.query.get_compiler(using='default')
                 resolved = ann.as_sql(compiler, connection)
                 replaced = resolved[0].replace(
                     '\"{}\"'.format(self.source_table_name), 'NEW'
@@ -111,82 +171,49 @@ class ReferenceSource(models.OneToOneField):
 
                 proxy_field_cols.append(proxy_field_col)
                 foreign_cols.append(
-                    (replaced, resolved[1], ann)
+                    (replaced, tuple(resolved[1]), ann)
                 )
-        return proxy_field_cols, foreign_cols
+        # Tuples, since the result is memoized and shared between the
+        # statements.
+        return tuple(proxy_field_cols), tuple(foreign_cols)
 
-    @property
+    @cached_property
     def trigger_function_statement(self):
 
         proxy_field_cols, foreign_cols = self.get_proxy_and_foreign_cols()
 
         fk_col_name = self.related_model._meta.pk.column
-        insert_col_names = [self.column] + proxy_field_cols
+        insert_col_names = (self.column,) + proxy_field_cols
         insert_value_cols = \
-            [('NEW.{}'.format(fk_col_name), [], None)] + foreign_cols
-
-        into_statement = (
-            '{ref_model_table}({comma_sep_cols})'.format(
-                ref_model_table=self.reference_model_table_name,
-                comma_sep_cols=', '.join([col for col in insert_col_names])
-            )
+            (('NEW.{}'.format(fk_col_name), (), None),) + foreign_cols
 
-        )
-
-        values_statement = (
-            '({comma_sep_cols})'.format(
-                comma_sep_cols=', '.join(
-                    [col for col, _, _ in insert_value_cols]
-                )
-            )
-        )
+        # Every foreign expression is rendered twice, once in the INSERT's
+        # VALUES and once in the UPDATE's SET, so its params are bound
+        # twice as well, in that order.
+        params = []
+        for group in (insert_value_cols, foreign_cols):
+            for _, col_params, _ in group:
+                params.extend(col_params)
 
-        set_statement = (
-            '({comma_sep_proxy}) = '
-            '({comma_sep_foreign})'.format(
-                comma_sep_proxy=', '.join(
-                    [col for col in proxy_field_cols]
-                ),
-                comma_sep_foreign=', '.join(
-                    [col for col, _, _ in foreign_cols]
-                )
-            )
-        )
         return (
-            'CREATE OR REPLACE FUNCTION {trigger_func_name} RETURNS trigger as '
-                '$$ '
-                    'BEGIN '
-                        'BEGIN '
-                            'INSERT INTO {into_statement} '
-                                'VALUES {values_statement}'
-                            '; '
-                        'EXCEPTION WHEN unique_violation THEN '
-                            'UPDATE {reference_model_table_name}'
-                                ' SET {set_statement}'
-                                ' WHERE {column} = NEW.{fk_col_name}'
-                            '; '
-                        'END; '
-                    'RETURN NEW; '
-                    'END '
-                '$$ LANGUAGE plpgsql'
-            ';'.format(
+            _TRIGGER_FUNCTION_TEMPLATE.format(
                 trigger_func_name=self.trigger_function_name,
-                into_statement=into_statement,
-                values_statement=values_statement,
                 reference_model_table_name=self.reference_model_table_name,
-                set_statement=set_statement,
+                insert_cols=', '.join(insert_col_names),
+                insert_values=', '.join(
+                    [col for col, _, _ in insert_value_cols]
+                ),
+                proxy_cols=', '.join(proxy_field_cols),
+                foreign_values=', '.join(
+                    [col for col, _, _ in foreign_cols]
+                ),
                 column=self.column,
                 fk_col_name=fk_col_name
             ),
-            [
-                param
-                for group in [insert_value_cols, foreign_cols]
-                    for _, params, _ in group
-                        for param in params
-            ]
-        )  # nopep8
+            tuple(params)
+        )
 
-    @property
+    @cached_property
     def drop_trigger_statement(self):
         return (
             'DROP TRIGGER IF EXISTS {trigger_name} '
@@ -195,19 +222,25 @@ class ReferenceSource(models.OneToOneField):
                 trigger_name=self.trigger_name,
                 table_name=self.source_table_name
             ),
-            []
+            ()
         )
 
-    @property
-    def create_trigger_statement(self):
+    @cached_property
+    def trigger_cols(self):
+        """
+        Source table columns read by the proxy expressions. Updates to any
+        of them have to fire the trigger.
+        """
         _, foreign_cols = self.get_proxy_and_foreign_cols()
-        trigger_cols = {
-            col.field.column
+        return {
+            _col_name(col)
             for _, _, exp in foreign_cols
             for col in self._find_cols(exp)
         }
 
-        comma_sep_trigger_cols = ', '.join([col for col in trigger_cols])
+    @cached_property
+    def create_trigger_statement(self):
+        comma_sep_trigger_cols = ', '.join(self.trigger_cols)
 
         return (
             'CREATE TRIGGER {trigger_name} AFTER INSERT '
@@ -220,10 +253,10 @@ class ReferenceSource(models.OneToOneField):
                 trigger_cols=comma_sep_trigger_cols,
                 trigger_func_name=self.trigger_function_name
             ),
-            []
+            ()
         )  # nopep8
 
-    @property
+    @cached_property
     def index_statement(self):
         return (
             'DO $$ '
@@ -236,10 +269,10 @@ class ReferenceSource(models.OneToOneField):
                     index_function_statement=self.index_function_statement,
                     index_name=self.index_name
                 ),
-            []
+            ()
         )  # nopep8
 
-    @property
+    @cached_property
     def index_function_statement(self):
         return (
             'CREATE UNIQUE INDEX ' + self.index_name + ' ON ' +
@@ -252,13 +285,25 @@ class AbstractProxy(object):
     Django doesn't pick up field changes if you have more than one __init__
     statement, so we have to have this hacky workaround.
     """
-    def _run_init(self,
-                  reference_field,
-                  foreign_field=None,
-                  foreign_fields=None):
+    # Most proxies mirror the reference field's own column, so these are
+    # only stored on the instance when given.
+    foreign_field = None
+    foreign_fields = None
+
+    def _run_init(self, reference_field, **kwargs):
+        # foreign_field and foreign_fields are keyword only.
+        foreign_field = kwargs.pop('foreign_field', None)
+        foreign_fields = kwargs.pop('foreign_fields', None)
+        if kwargs:
+            raise TypeError(
+                'Unexpected proxy arguments: %s' % ', '.join(sorted(kwargs))
+            )
+
         self.reference_field = reference_field
-        self.foreign_fields = foreign_fields
-        self.foreign_field = foreign_field
+        if foreign_fields is not None:
+            self.foreign_fields = foreign_fields
+        if foreign_field is not None:
+            self.foreign_field = foreign_field
 
     @property
     def foreign_column(self):
@@ -356,10 +401,17 @@ class ReferenceQuerySet(models.QuerySet):
     def select_sources(self, *sources):
         if not len(sources):
             raise Exception('At least one source needs to be specified')
-        q = models.Q()
-        for source in self.model.get_reference_sources():
-            if source.attname in sources or source.name in sources:
-                q |= models.Q(**{'{}__isnull'.format(source.attname): False})
+        lookup = self.model._source_q_lookup()
+        selected = []
+        for source in sources:
+            q = lookup.get(source)
+            if q is not None and q not in selected:
+                selected.append(q)
+        # One flat OR node, rather than re-nesting the tree with every |.
+        # The connector is set afterwards because Q only accepts
+        # _connector from Django 2.0.
+        q = models.Q(*selected)
+        q.connector = models.Q.OR
         return self.filter(
             q
         )
@@ -382,26 +434,66 @@ class ReferenceModel(models.Model):
 
     objects = ReferenceManager()
 
+    # Proxies and sources are fixed once the model class is prepared, so
+    # they are looked up once per class and reused.
+    _field_proxies_cache = {}
+    _reference_sources_cache = {}
+    _source_q_lookup_cache = {}
+    _unpack_plan_cache = {}
+
     class Meta:
         abstract = True
 
     @classmethod
     def get_field_proxies(cls):
-        class_attrs = cls.__dict__.values()
-        fields = cls._meta.get_fields()
-        class_attrs.extend(fields)
-        return [
-            f for f in class_attrs
-            if isinstance(f, AbstractProxy)
-        ]
+        try:
+            return cls._field_proxies_cache[cls]
+        except KeyError:
+            class_attrs = list(cls.__dict__.values())
+            class_attrs += list(cls._meta.get_fields())
+            cls._field_proxies_cache[cls] = proxies = [
+                f for f in class_attrs
+                if isinstance(f, AbstractProxy)
+            ]
+            return proxies
 
     @classmethod
     def get_reference_sources(cls):
-        fields = cls._meta.get_fields()
-        return [
-            f for f in fields
-            if isinstance(f, ReferenceSource)
-        ]
+        try:
+            return cls._reference_sources_cache[cls]
+        except KeyError:
+            cls._reference_sources_cache[cls] = sources = [
+                f for f in cls._meta.get_fields()
+                if isinstance(f, ReferenceSource)
+            ]
+            return sources
+
+    @classmethod
+    def _source_q_lookup(cls):
+        """
+        Maps both the name and the attname of each source to a Q that
+        selects the rows pointing at that source.
+        """
+        try:
+            return cls._source_q_lookup_cache[cls]
+        except KeyError:
+            lookup = {}
+            for source in cls.get_reference_sources():
+                q = models.Q(**{'{}__isnull'.format(source.attname): False})
+                lookup[source.name] = lookup[source.attname] = q
+            cls._source_q_lookup_cache[cls] = lookup
+            return lookup
+
+    @classmethod
+    def _unpack_plan(cls):
+        try:
+            return cls._unpack_plan_cache[cls]
+        except KeyError:
+            cls._unpack_plan_cache[cls] = plan = tuple(
+                (source.attname, source.name)
+                for source in cls.get_reference_sources()
+            )
+            return plan
 
     @classmethod
     def make_add_constaint_statement(cls):
@@ -448,15 +540,14 @@ class ReferenceModel(models.Model):
 
     @classmethod
     def _gen_trigger_statements(cls):
-        return (
-            statement
+        return chain.from_iterable(
+            (
+                reference.trigger_function_statement,
+                reference.drop_trigger_statement,
+                reference.create_trigger_statement
+            )
             for reference in cls.get_reference_sources()
-                for statement in (
-                    reference.trigger_function_statement,
-                    reference.drop_trigger_statement,
-                    reference.create_trigger_statement
-                )
-        )  # nopep8
+        )
 
     @classmethod
     def _gen_index_statements(cls):
@@ -476,13 +567,10 @@ class ReferenceModel(models.Model):
 
     @classmethod
     def _gen_all_statements(cls):
-        return (
-            x for group in (
-                cls._gen_constraint_statements(),
-                cls._gen_index_statements(),
-                cls._gen_trigger_statements()
-            )
-            for x in group
+        return chain(
+            cls._gen_constraint_statements(),
+            cls._gen_index_statements(),
+            cls._gen_trigger_statements()
         )
 
     @classmethod
@@ -503,14 +591,33 @@ class ReferenceModel(models.Model):
 
     @classmethod
     def _execute_sql(cls, iterable):
-        with connection.cursor() as cursor:
-            for statement, params in iterable:
-                cursor.execute(statement, params)
+        # Every statement is run with a params list, so the driver
+        # interpolates them client side (it has to; the trigger function
+        # params sit inside a dollar-quoted body). That lets the whole
+        # migration go to the database as one batch, with the params
+        # concatenated in statement order.
+        statements = []
+        params = []
+        for statement, statement_params in iterable:
+            statements.append(statement.rstrip(';'))
+            params.extend(statement_params)
+
+        if not statements:
+            return
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute('; '.join(statements) + ';', params)
 
     def unpack(self):
-        for source in self.get_reference_sources():
-            if getattr(self, source.column) is not None:
-                return getattr(self, source.name)
+        for attname, name in self._unpack_plan():
+            # Read the loaded fk value directly, falling back to getattr
+            # only when the column was deferred.
+            try:
+                value = self.__dict__[attname]
+            except KeyError:
+                value = getattr(self, attname)
+            if value is not None:
+                return getattr(self, name)
 
         raise Exception('Reference has no source')
 
@@ -0,0 +1,17 @@
+import django
+from django.conf import settings
+
+
+def pytest_configure():
+    # Only SQL generation is exercised, so no database server is needed;
+    # the postgres backend is configured for its quoting and operators.
+    settings.configure(
+        DATABASES={
+            'default': {
+                'ENGINE': 'django.db.backends.postgresql',
+                'NAME': 'polymorphic',
+            }
+        },
+        INSTALLED_APPS=['tests.testapp'],
+    )
+    django.setup()
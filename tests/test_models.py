@@ -0,0 +1,210 @@
+import copy
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import pytest
+from django.core.exceptions import FieldError
+from django.db.models import DEFERRED
+
+from polymorphic.models import FieldProxy, ProxiedTextField
+from tests.testapp.models import (
+    Book,
+    JoinedReference,
+    MediaReference,
+    Song,
+    SongReference,
+    TypoReference,
+)
+
+
+def get_source(model, name):
+    return model._meta.get_field(name)
+
+
+def test_fk_proxy_mirrors_source_fk_column():
+    sql, params = get_source(MediaReference, 'song').trigger_function_statement
+    assert (
+        'INSERT INTO testapp_mediareference(song_id, owner_id, title, weight) '
+        'VALUES (NEW.id, NEW."owner_id", NEW."title", (NEW."runtime" * %s))'
+    ) in sql
+    assert (
+        'SET (owner_id, title, weight) = '
+        '(NEW."owner_id", NEW."title", (NEW."runtime" * %s))'
+    ) in sql
+    assert params == (30, 30)
+
+
+def test_foreign_fields_override():
+    sql, params = get_source(MediaReference, 'book').trigger_function_statement
+    assert 'VALUES (NEW.id, NEW."owner_id", NEW."title", NEW."num_pages")' \
+        in sql
+    assert params == ()
+
+
+def test_joined_expression_is_rejected():
+    with pytest.raises(Exception) as excinfo:
+        get_source(JoinedReference, 'song').get_proxy_and_foreign_cols()
+    assert not isinstance(excinfo.value, FieldError)
+    assert str(excinfo.value) == (
+        "Proxy expressions can only use 1 table, got {'testapp_owner'}"
+    )
+
+
+def test_proxies_resolved_after_fk_proxy():
+    # The fk proxy leaves a trimmed join in the shared query; the proxies
+    # resolved after it still only read the source table.
+    proxy_cols, foreign_cols = \
+        get_source(MediaReference, 'book').get_proxy_and_foreign_cols()
+    assert proxy_cols == ('owner_id', 'title', 'weight')
+    assert [col for col, _, _ in foreign_cols] == [
+        'NEW."owner_id"', 'NEW."title"', 'NEW."num_pages"'
+    ]
+
+
+def test_trigger_fires_on_proxied_source_columns():
+    song = get_source(MediaReference, 'song')
+    assert song.trigger_cols == {'owner_id', 'title', 'runtime'}
+    sql, params = song.create_trigger_statement
+    assert sql.startswith(
+        'CREATE TRIGGER update_testapp_song_testapp_mediareference_trigger '
+        'AFTER INSERT OR UPDATE OF '
+    )
+    assert params == ()
+
+
+def test_proxied_field_can_be_copied():
+    field = ProxiedTextField(foreign_field='title')
+    copied = copy.copy(field)
+    assert copied.foreign_field == 'title'
+    assert copied.reference_field is field
+
+
+def test_proxy_inherited_from_abstract_reference_model():
+    title = SongReference._meta.get_field('title')
+    assert SongReference.get_field_proxies() == [title]
+    sql, params = get_source(SongReference, 'song').trigger_function_statement
+    assert (
+        'INSERT INTO testapp_songreference(song_id, title) '
+        'VALUES (NEW.id, NEW."title")'
+    ) in sql
+
+
+def test_field_proxy_defaults_are_not_stored():
+    title = MediaReference._meta.get_field('title')
+    proxy = FieldProxy(title)
+    assert proxy.foreign_field is None
+    assert proxy.foreign_fields is None
+    assert proxy.foreign_column == 'title'
+    assert 'foreign_field' not in proxy.__dict__
+    assert 'foreign_fields' not in proxy.__dict__
+
+
+def test_field_proxy_options_are_keyword_only():
+    title = MediaReference._meta.get_field('title')
+    song = get_source(MediaReference, 'song')
+    with pytest.raises(TypeError):
+        FieldProxy(title, {song: 'title'})
+    with pytest.raises(TypeError):
+        FieldProxy(title, foreign_feilds={song: 'title'})
+    proxy = FieldProxy(title, foreign_fields={song: 'title'})
+    assert proxy.foreign_fields == {song: 'title'}
+
+
+
+def test_unknown_column_raises_field_error():
+    with pytest.raises(FieldError):
+        get_source(TypoReference, 'song').get_proxy_and_foreign_cols()
+
+
+def test_migration_sql_is_sent_in_one_execute():
+    connection = mock.MagicMock()
+    cursor = connection.cursor.return_value.__enter__.return_value
+    with mock.patch('polymorphic.models.connection', connection), \
+            mock.patch('polymorphic.models.transaction.atomic'):
+        MediaReference._run_sql_statements()
+
+    assert cursor.execute.call_count == 1
+    sql, params = cursor.execute.call_args[0]
+    assert params == [30, 30]
+    assert sql.count('%s') == 2
+
+    markers = [
+        'ALTER TABLE testapp_mediareference DROP CONSTRAINT',
+        'ALTER TABLE testapp_mediareference ADD CONSTRAINT',
+        'CREATE UNIQUE INDEX unique_testapp_song_testapp_mediareference_ix',
+        'CREATE UNIQUE INDEX unique_testapp_book_testapp_mediareference_ix',
+        'CREATE OR REPLACE FUNCTION update_testapp_song_',
+        'DROP TRIGGER IF EXISTS update_testapp_song_',
+        'CREATE TRIGGER update_testapp_song_',
+        'CREATE OR REPLACE FUNCTION update_testapp_book_',
+        'DROP TRIGGER IF EXISTS update_testapp_book_',
+        'CREATE TRIGGER update_testapp_book_',
+    ]
+    positions = [sql.index(marker) for marker in markers]
+    assert positions == sorted(positions)
+
+
+def test_cached_statement_params_are_immutable():
+    song = get_source(MediaReference, 'song')
+    for statement in (
+        song.trigger_function_statement,
+        song.drop_trigger_statement,
+        song.create_trigger_statement,
+        song.index_statement,
+    ):
+        assert isinstance(statement[1], tuple)
+
+
+def where_sql(queryset):
+    sql = str(queryset.query)
+    return sql.split(' WHERE ', 1)[1] if ' WHERE ' in sql else None
+
+
+def test_select_sources_ors_selected_sources():
+    queryset = MediaReference.objects.all().select_sources('song', 'book_id')
+    assert where_sql(queryset) == (
+        '("testapp_mediareference"."song_id" IS NOT NULL OR '
+        '"testapp_mediareference"."book_id" IS NOT NULL)'
+    )
+
+
+def test_select_sources_by_name_and_attname_adds_one_clause():
+    queryset = MediaReference.objects.all().select_sources('song', 'song_id')
+    assert where_sql(queryset) == (
+        '"testapp_mediareference"."song_id" IS NOT NULL'
+    )
+
+
+def test_select_sources_ignores_unknown_names():
+    queryset = MediaReference.objects.all().select_sources('movie')
+    assert where_sql(queryset) is None
+
+
+def test_unpack_returns_loaded_source():
+    book = Book(pk=3, title='Dune', owner_id=1, num_pages=412)
+    assert MediaReference(book=book).unpack() is book
+
+
+def test_unpack_without_source_raises():
+    with pytest.raises(Exception) as excinfo:
+        MediaReference().unpack()
+    assert str(excinfo.value) == 'Reference has no source'
+
+
+def test_unpack_loads_deferred_source_column():
+    song = Song(pk=7, title='Blue', owner_id=1, runtime=200)
+    names = [f.attname for f in MediaReference._meta.concrete_fields]
+    reference = MediaReference.from_db('default', names, [
+        DEFERRED if name == 'song_id' else None for name in names
+    ])
+    assert 'song_id' not in reference.__dict__
+
+    def refresh_from_db(fields=None, **kwargs):
+        assert fields == ['song_id']
+        reference.song = song
+
+    with mock.patch.object(reference, 'refresh_from_db', refresh_from_db):
+        assert reference.unpack() is song
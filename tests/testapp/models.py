@@ -0,0 +1,60 @@
+from django.db import models
+
+from polymorphic.models import (
+    ProxiedForeignKey,
+    ProxiedIntegerField,
+    ProxiedTextField,
+    ReferenceModel,
+    ReferenceSource,
+)
+
+
+class Owner(models.Model):
+    name = models.TextField()
+
+
+class Song(models.Model):
+    title = models.TextField()
+    owner = models.ForeignKey(Owner, on_delete=models.CASCADE)
+    runtime = models.IntegerField()
+
+
+class Book(models.Model):
+    title = models.TextField()
+    owner = models.ForeignKey(Owner, on_delete=models.CASCADE)
+    num_pages = models.IntegerField()
+
+
+class MediaReference(ReferenceModel):
+    song = ReferenceSource(Song, on_delete=models.CASCADE)
+    book = ReferenceSource(Book, on_delete=models.CASCADE)
+
+    owner = ProxiedForeignKey(Owner, on_delete=models.CASCADE)
+    title = ProxiedTextField()
+    weight = ProxiedIntegerField(foreign_fields={
+        song: models.F('runtime') * 30,
+        book: 'num_pages',
+    })
+
+
+class JoinedReference(ReferenceModel):
+    song = ReferenceSource(Song, on_delete=models.CASCADE)
+
+    owner_name = ProxiedTextField(foreign_field=models.F('owner__name'))
+
+
+class TypoReference(ReferenceModel):
+    song = ReferenceSource(Song, on_delete=models.CASCADE)
+
+    title = ProxiedTextField(foreign_field='titel')
+
+
+class TitledReference(ReferenceModel):
+    title = ProxiedTextField()
+
+    class Meta(ReferenceModel.Meta):
+        abstract = True
+
+
+class SongReference(TitledReference):
+    song = ReferenceSource(Song, on_delete=models.CASCADE)